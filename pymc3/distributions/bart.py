@@ -26,6 +26,8 @@ class BaseBART(NoDistribution):
     def __init__(self, X, Y, m=200, alpha=0.25, split_prior=None, *args, **kwargs):
 
         self.X, self.Y, self.missing_data = self.preprocess_XY(X, Y)
+        # The missing values do not change while sampling, so we find them only once
+        self.nan_mask = np.isnan(self.X) if self.missing_data else None
 
         super().__init__(shape=X.shape[0], dtype="float64", initval=0, *args, **kwargs)
 
@@ -52,12 +54,16 @@ class BaseBART(NoDistribution):
         self.num_observations = X.shape[0]
         self.num_variates = X.shape[1]
         self.available_predictors = list(range(self.num_variates))
-        self.ssv = SampleSplittingVariable(split_prior, self.num_variates)
+        self.X_unique, self.X_rank = rank_predictors(self.X)
+        self.uniform = UniformSampler()
+        self.ssv = SampleSplittingVariable(split_prior, self.num_variates, self.uniform)
         self.m = m
         self.alpha = alpha
         self.trees = self.init_list_of_trees()
         self.all_trees = []
-        self.mean = fast_mean()
+        self.residual_means = fast_residual_means()
+        self.split_idx_data_points = fast_split_idx_data_points()
+        self.add_tree_output = fast_add_tree_output()
         self.prior_prob_leaf_node = compute_prior_probability(alpha)
 
     def preprocess_XY(self, X, Y):
@@ -67,11 +73,13 @@ class BaseBART(NoDistribution):
             X = X.to_numpy()
         missing_data = np.any(np.isnan(X))
         X = np.random.normal(X, np.std(X, 0) / 100)
+        # Column-major order makes the values of each predictor contiguous in memory
+        X = np.asfortranarray(X)
         return X, Y, missing_data
 
     def init_list_of_trees(self):
         initial_value_leaf_nodes = self.Y.mean() / self.m
-        initial_idx_data_points_leaf_nodes = np.array(range(self.num_observations), dtype="int32")
+        initial_idx_data_points_leaf_nodes = np.arange(self.num_observations, dtype="int32")
         list_of_trees = []
         for i in range(self.m):
             new_tree = Tree.init_tree(
@@ -84,7 +92,11 @@ class BaseBART(NoDistribution):
         # bartMachine: A Powerful Tool for Machine Learning in R. ArXiv e-prints, 2013
         # The sum_trees_output will contain the sum of the predicted output for all trees.
         # When R_j is needed we subtract the current predicted output for tree T_j.
-        self.sum_trees_output = np.full_like(self.Y, self.Y.mean())
+        self.sum_trees_output = np.empty(self.num_observations, dtype="float64")
+        self.sum_trees_output.fill(self.Y.mean())
+        # The sum of the predicted output of all trees except T_j, set by the step method
+        # while T_j is being replaced. The new leaf nodes are the means of R_j = Y - noi.
+        self.sum_trees_output_noi = np.empty(self.num_observations, dtype="float64")
 
         return list_of_trees
 
@@ -94,30 +106,42 @@ class BaseBART(NoDistribution):
     def __repr_latex(self):
         raise NotImplementedError
 
-    def get_available_splitting_rules(self, idx_data_points_split_node, idx_split_variable):
-        x_j = self.X[idx_data_points_split_node, idx_split_variable]
-        if self.missing_data:
-            x_j = x_j[~np.isnan(x_j)]
-        values = np.unique(x_j)
-        # The last value is never available as it would leave the right subtree empty.
-        return values[:-1]
+    def get_available_splitting_ranks(self, idx_data_points_split_node, idx_split_variable):
+        nan_mask_j = self.nan_mask[:, idx_split_variable] if self.missing_data else None
+        return available_splitting_ranks(
+            idx_data_points_split_node,
+            self.X_rank[:, idx_split_variable],
+            self.X_unique[idx_split_variable].size,
+            nan_mask_j,
+        )
+
+    def draw_split_nodes(self, current_node):
+        """
+        Draw the nodes needed to grow the tree from a leaf node, without modifying the tree.
 
-    def grow_tree(self, tree, index_leaf_node):
-        current_node = tree.get_node(index_leaf_node)
+        Returns None when the leaf node can not be split, otherwise returns the index of the
+        selected predictor, the new SplitNode and the new left and right LeafNodes.
+        """
+        # A node with less than two data points has no splitting rules for any predictor
+        if current_node.idx_data_points.size < 2:
+            return None
 
         index_selected_predictor = self.ssv.rvs()
         selected_predictor = self.available_predictors[index_selected_predictor]
-        available_splitting_rules = self.get_available_splitting_rules(
+        available_splitting_ranks = self.get_available_splitting_ranks(
             current_node.idx_data_points, selected_predictor
         )
         # This can be unsuccessful when there are not available splitting rules
-        if available_splitting_rules.size == 0:
-            return False, None
-
-        index_selected_splitting_rule = discrete_uniform_sampler(len(available_splitting_rules))
-        selected_splitting_rule = available_splitting_rules[index_selected_splitting_rule]
+        if available_splitting_ranks.size == 0:
+            return None
+
+        # Only the selected splitting rule is read from the unique values of the predictor
+        index_selected_splitting_rule = int(self.uniform.random() * available_splitting_ranks.size)
+        selected_splitting_rule = self.X_unique[selected_predictor][
+            available_splitting_ranks[index_selected_splitting_rule]
+        ]
         new_split_node = SplitNode(
-            index=index_leaf_node,
+            index=current_node.index,
             idx_split_variable=selected_predictor,
             split_value=selected_splitting_rule,
         )
@@ -126,8 +150,9 @@ class BaseBART(NoDistribution):
             new_split_node, current_node.idx_data_points
         )
 
-        left_node_value = self.draw_leaf_value(left_node_idx_data_points)
-        right_node_value = self.draw_leaf_value(right_node_idx_data_points)
+        left_node_value, right_node_value = self.draw_leaf_values(
+            left_node_idx_data_points, right_node_idx_data_points
+        )
 
         new_left_node = LeafNode(
             index=current_node.get_idx_left_child(),
@@ -139,47 +164,34 @@ class BaseBART(NoDistribution):
             value=right_node_value,
             idx_data_points=right_node_idx_data_points,
         )
-        tree.grow_tree(index_leaf_node, new_split_node, new_left_node, new_right_node)
 
-        return True, index_selected_predictor
+        return index_selected_predictor, new_split_node, new_left_node, new_right_node
 
     def get_new_idx_data_points(self, current_split_node, idx_data_points):
         idx_split_variable = current_split_node.idx_split_variable
         split_value = current_split_node.split_value
 
-        left_idx = self.X[idx_data_points, idx_split_variable] <= split_value
-        left_node_idx_data_points = idx_data_points[left_idx]
-        right_node_idx_data_points = idx_data_points[~left_idx]
-
-        return left_node_idx_data_points, right_node_idx_data_points
-
-    def get_residuals(self):
-        """Compute the residuals."""
-        R_j = self.Y - self.sum_trees_output
-        return R_j
-
-    def get_residuals_loo(self, tree):
-        """Compute the residuals without leaving the passed tree out."""
-        R_j = self.Y - (self.sum_trees_output - tree.predict_output(self.num_observations))
-        return R_j
+        return self.split_idx_data_points(
+            self.X[:, idx_split_variable], idx_data_points, split_value
+        )
 
-    def draw_leaf_value(self, idx_data_points):
-        """ Draw the residual mean."""
-        R_j = self.get_residuals()[idx_data_points]
-        draw = self.mean(R_j)
-        return draw
+    def draw_leaf_values(self, left_idx_data_points, right_idx_data_points):
+        """ Draw the residual means of the two new leaf nodes."""
+        draws = self.residual_means(
+            self.Y, self.sum_trees_output_noi, left_idx_data_points, right_idx_data_points
+        )
+        return draws
 
     def predict(self, X_new):
         """Compute out of sample predictions evaluated at X_new"""
         trees = self.all_trees
+        X_new = np.asarray(X_new, dtype="float64")
         num_observations = X_new.shape[0]
         pred = np.zeros((len(trees), num_observations))
         np.random.randint(len(trees))
         for draw, trees_to_sum in enumerate(trees):
-            new_Y = np.zeros(num_observations)
             for tree in trees_to_sum:
-                new_Y += [tree.predict_out_of_sample(x) for x in X_new]
-            pred[draw] = new_Y
+                self.add_tree_output(X_new, *tree.to_array_layout(), pred[draw])
         return pred
 
 
@@ -209,33 +221,209 @@ def compute_prior_probability(alpha):
     return prior_leaf_prob
 
 
-def fast_mean():
-    """If available use Numba to speed up the computation of the mean."""
+def rank_predictors(X):
+    """
+    Compute the sorted unique values of each predictor and the rank of each observation among them.
+
+    Parameters
+    ----------
+    X : numpy array
+        The design matrix.
+
+    Returns
+    -------
+    X_unique : list
+        Sorted unique values of each column of X.
+    X_rank : numpy array
+        Array with the same shape as X with the position of each value in X_unique.
+    """
+    X_unique = []
+    X_rank = np.empty(X.shape, dtype="int32", order="F")
+    for j in range(X.shape[1]):
+        unique_j, X_rank[:, j] = np.unique(X[:, j], return_inverse=True)
+        X_unique.append(unique_j)
+    return X_unique, X_rank
+
+
+def available_splitting_ranks(idx_data_points, x_rank_j, num_unique_j, nan_mask_j=None):
+    """
+    Compute the ranks of the values of a predictor that are available as splitting rules.
+
+    Parameters
+    ----------
+    idx_data_points : numpy array
+        Data points of the node to split.
+    x_rank_j : numpy array
+        Rank of each observation among the unique values of the predictor.
+    num_unique_j : int
+        Number of unique values of the predictor.
+    nan_mask_j : numpy array, optional
+        True for the observations with a missing value of the predictor.
+
+    Returns
+    -------
+    numpy array
+        Sorted ranks of the values of the node, except the largest one.
+    """
+    if nan_mask_j is not None:
+        idx_data_points = idx_data_points[~nan_mask_j[idx_data_points]]
+    ranks = x_rank_j[idx_data_points]
+    if ranks.size > x_rank_j.size // 8:
+        # For large nodes marking the ranks present is cheaper than sorting them
+        present = np.zeros(num_unique_j, dtype=bool)
+        present[ranks] = True
+        ranks = np.flatnonzero(present)
+    else:
+        ranks = np.unique(ranks)
+    # The last value is never available as it would leave the right subtree empty.
+    return ranks[:-1]
+
+
+def fast_residual_means():
+    """If available use Numba to speed up the computation of the mean of the residuals."""
     try:
-        from numba import jit
+        from numba import njit
     except ImportError:
-        return np.mean
-
-    @jit
-    def mean(a):
-        count = a.shape[0]
-        suma = 0
-        for i in range(count):
-            suma += a[i]
+
+        def residual_means(Y, sum_trees_output, left_idx_data_points, right_idx_data_points):
+            return (
+                np.mean(Y[left_idx_data_points] - sum_trees_output[left_idx_data_points]),
+                np.mean(Y[right_idx_data_points] - sum_trees_output[right_idx_data_points]),
+            )
+
+        return residual_means
+
+    # The residuals are computed, gathered and averaged in a single pass.
+    # fastmath allows the reduction to be reordered and vectorized
+    @njit(fastmath=True)
+    def residual_mean(Y, sum_trees_output, idx_data_points):
+        count = idx_data_points.shape[0]
+        suma = 0.0
+        for k in range(count):
+            i = idx_data_points[k]
+            suma += Y[i] - sum_trees_output[i]
         return suma / count
 
-    return mean
+    # Both leaf nodes are computed with a single call from Python
+    @njit
+    def residual_means(Y, sum_trees_output, left_idx_data_points, right_idx_data_points):
+        return (
+            residual_mean(Y, sum_trees_output, left_idx_data_points),
+            residual_mean(Y, sum_trees_output, right_idx_data_points),
+        )
+
+    return residual_means
+
+
+def split_idx_data_points(x_j, idx_data_points, split_value):
+    """
+    Split the data points of a node between its left and right children.
+
+    Data points with a missing value (NaN) go to the right child.
+    """
+    left_idx = x_j[idx_data_points] <= split_value
+    return idx_data_points[left_idx], idx_data_points[~left_idx]
+
+
+def fast_split_idx_data_points():
+    """If available use Numba to speed up splitting the data points of a node."""
+    try:
+        from numba import njit
+    except ImportError:
+        return split_idx_data_points
+
+    # Branchless partition: both stores always happen and only the counters depend on the
+    # comparison, the store into the "wrong" buffer is overwritten in the next iteration.
+    # fastmath is not used because NaN values (missing data) must always go to the right.
+    @njit(boundscheck=False)
+    def split_idx_data_points_numba(x_j, idx_data_points, split_value):
+        count = idx_data_points.shape[0]
+        left = np.empty_like(idx_data_points)
+        right = np.empty_like(idx_data_points)
+        n_left = 0
+        n_right = 0
+        for k in range(count):
+            i = idx_data_points[k]
+            is_left = int(x_j[i] <= split_value)
+            left[n_left] = i
+            right[n_right] = i
+            n_left += is_left
+            n_right += 1 - is_left
+        return left[:n_left], right[:n_right]
+
+    return split_idx_data_points_numba
+
+
+def add_tree_output(X, idx_split_variable, split_value, idx_left_child, leaf_value, output):
+    """
+    Add the predicted output of a tree, stored with Tree.to_array_layout, for each row of X.
+    """
+    rows = np.arange(X.shape[0])
+    idx_nodes = np.zeros(X.shape[0], dtype="int32")
+    active = idx_left_child[idx_nodes] >= 0
+    # All the observations still in a SplitNode go down one level at a time
+    while active.any():
+        idx_active = idx_nodes[active]
+        go_left = X[rows[active], idx_split_variable[idx_active]] <= split_value[idx_active]
+        # The right child is next to the left child, NaN values go to the right child
+        idx_nodes[active] = idx_left_child[idx_active] + 1 - go_left
+        active = idx_left_child[idx_nodes] >= 0
+    output += leaf_value[idx_nodes]
+
+
+def fast_add_tree_output():
+    """If available use Numba to speed up the out of sample predictions of a tree."""
+    try:
+        from numba import njit
+    except ImportError:
+        return add_tree_output
+
+    # Branchless walk: the right child is next to the left child, so the comparison only
+    # selects the offset. NaN values go to the right child.
+    @njit
+    def add_tree_output_numba(
+        X, idx_split_variable, split_value, idx_left_child, leaf_value, output
+    ):
+        for i in range(X.shape[0]):
+            idx = 0
+            while idx_left_child[idx] >= 0:
+                go_left = int(X[i, idx_split_variable[idx]] <= split_value[idx])
+                idx = idx_left_child[idx] + 1 - go_left
+            output[i] += leaf_value[idx]
+
+    return add_tree_output_numba
+
+
+class UniformSampler:
+    """
+    Cache samples from the standard uniform distribution.
+
+    Draws are generated in batches and stored in a NumPy array, so each call to `random` only
+    needs to read one element instead of calling into NumPy's random number generator.
+    """
+
+    def __init__(self, size=10_000):
+        self.size = size
+        self.cache = None
+        self.idx = size
 
+    def random(self):
+        if self.idx >= self.size:
+            self.update()
+        value = self.cache[self.idx]
+        self.idx += 1
+        return value
 
-def discrete_uniform_sampler(upper_value):
-    """Draw from the uniform distribution with bounds [0, upper_value)."""
-    return int(np.random.random() * upper_value)
+    def update(self):
+        self.cache = np.random.random(self.size)
+        self.idx = 0
 
 
 class SampleSplittingVariable:
-    def __init__(self, prior, num_variates):
+    def __init__(self, prior, num_variates, uniform):
         self.prior = prior
         self.num_variates = num_variates
+        self.uniform = uniform
 
         if self.prior is not None:
             self.prior = np.asarray(self.prior)
@@ -245,16 +433,15 @@ class SampleSplittingVariable:
                     f"The size of split_prior ({self.prior.size}) should be the "
                     f"same as the number of covariates ({self.num_variates})"
                 )
-            self.enu = list(enumerate(np.cumsum(self.prior)))
+            self.cdf = np.cumsum(self.prior)
+            # Rounding can leave the last value below 1, searchsorted must stay in range
+            self.cdf[-1] = 1.0
 
     def rvs(self):
         if self.prior is None:
-            return int(np.random.random() * self.num_variates)
+            return int(self.uniform.random() * self.num_variates)
         else:
-            r = np.random.random()
-            for i, v in self.enu:
-                if r <= v:
-                    return i
+            return int(np.searchsorted(self.cdf, self.uniform.random()))
 
 
 class BART(BaseBART):
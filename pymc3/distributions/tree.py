@@ -51,6 +51,7 @@ class Tree:
         self.idx_leaf_nodes = []
         self.idx_prunable_split_nodes = []
         self.tree_id = tree_id
+        self._array_layout = None
 
     def __getitem__(self, index):
         return self.get_node(index)
@@ -66,6 +67,7 @@ class Tree:
 
     def set_node(self, index, node):
         self.tree_structure[index] = node
+        self._array_layout = None
         self.num_nodes += 1
         if isinstance(node, LeafNode):
             self.idx_leaf_nodes.append(index)
@@ -75,6 +77,7 @@ class Tree:
         if isinstance(current_node, LeafNode):
             self.idx_leaf_nodes.remove(index)
         del self.tree_structure[index]
+        self._array_layout = None
         self.num_nodes -= 1
 
     def predict_output(self, num_observations):
@@ -84,6 +87,45 @@ class Tree:
             output[current_node.idx_data_points] = current_node.value
         return output
 
+    def to_array_layout(self):
+        """
+        Store the tree in arrays, with the nodes numbered consecutively in breadth-first order.
+
+        The arrays have one element per node and are computed the first time they are needed
+        after the tree changes.
+
+        Returns
+        -------
+        idx_split_variable : numpy array
+            Index of the splitting variable of each SplitNode.
+        split_value : numpy array
+            Splitting value of each SplitNode.
+        idx_left_child : numpy array
+            Position of the left child of each SplitNode, -1 for the LeafNodes. The right child
+            is always at the next position.
+        leaf_value : numpy array
+            Value of each LeafNode.
+        """
+        if self._array_layout is None:
+            idx_split_variable = np.zeros(self.num_nodes, dtype="int32")
+            split_value = np.zeros(self.num_nodes)
+            idx_left_child = np.full(self.num_nodes, -1, dtype="int32")
+            leaf_value = np.zeros(self.num_nodes)
+            # Indexes of the nodes in the tree_structure, in the order we number them
+            node_indexes = [0]
+            for position, index in enumerate(node_indexes):
+                node = self.get_node(index)
+                if isinstance(node, SplitNode):
+                    idx_split_variable[position] = node.idx_split_variable
+                    split_value[position] = node.split_value
+                    idx_left_child[position] = len(node_indexes)
+                    node_indexes.append(node.get_idx_left_child())
+                    node_indexes.append(node.get_idx_right_child())
+                else:
+                    leaf_value[position] = node.value
+            self._array_layout = (idx_split_variable, split_value, idx_left_child, leaf_value)
+        return self._array_layout
+
     def predict_out_of_sample(self, x):
         """
         Predict output of tree for an unobserved point x.
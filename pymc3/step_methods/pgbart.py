@@ -14,6 +14,8 @@
 
 import logging
 
+from copy import copy
+
 import numpy as np
 
 from aesara import function as aesara_function
@@ -74,11 +76,23 @@ class PGBART(ArrayStepShared):
         self.bart.chunk = self.chunk
         self.num_particles = num_particles
         self.log_num_particles = np.log(num_particles)
-        self.indices = list(range(1, num_particles))
+        # The weights and likelihoods of the particles are stored by particle position
+        self.log_weights = np.empty(num_particles)
+        self.old_likelihoods = np.empty(num_particles)
+        self.len_indices = num_particles - 1
         self.max_stages = max_stages
+        # Sum of the predicted output of all the trees except the one we are replacing,
+        # shared with BART so the new leaf nodes are drawn from the same residuals R_j
+        self.sum_trees_output_noi = self.bart.sum_trees_output_noi
+        # Buffer for the sum of trees output passed to the likelihood
+        self.output_buffer = np.empty(self.bart.num_observations)
         self.old_trees_particles_list = []
         for i in range(self.bart.m):
-            p = ParticleTree(self.bart.trees[i], self.bart.prior_prob_leaf_node)
+            p = ParticleTree(
+                self.bart.trees[i],
+                self.bart.prior_prob_leaf_node,
+                self.bart.trees[i].predict_output(self.bart.num_observations),
+            )
             self.old_trees_particles_list.append(p)
 
         shared = make_shared_replacements(initial_values, vars, model)
@@ -101,56 +115,57 @@ class PGBART(ArrayStepShared):
         if self.idx == bart.m:
             self.idx = 0
 
+        # The array returned by the previous step is left untouched,
+        # the new trees update this copy in place
+        bart.sum_trees_output = bart.sum_trees_output.copy()
+
         for idx in range(self.idx, self.idx + self.chunk):
             if idx >= bart.m:
                 break
             self.idx += 1
             tree = bart.trees[idx]
-            R_j = bart.get_residuals_loo(tree)
+            # The old particle keeps the predicted output of the tree we are replacing
+            old_prediction = self.old_trees_particles_list[tree.tree_id].prediction
+            np.subtract(bart.sum_trees_output, old_prediction, out=self.sum_trees_output_noi)
             # Generate an initial set of SMC particles
             # at the end of the algorithm we return one of these particles as the new tree
-            particles = self.init_particles(tree.tree_id, R_j, num_observations)
+            particles = self.init_particles(tree.tree_id, num_observations)
 
             for t in range(1, max_stages):
                 # Get old particle at stage t
                 particles[0] = self.get_old_tree_particle(tree.tree_id, t)
                 # sample each particle (try to grow each tree)
                 for c in range(1, self.num_particles):
-                    particles[c].sample_tree_sequential(bart)
-                # Update weights. Since the prior is used as the proposal,the weights
-                # are updated additively as the ratio of the new and old log_likelihoods
-                for p_idx, p in enumerate(particles):
-                    new_likelihood = self.likelihood_logp(p.tree.predict_output(num_observations))
-                    p.log_weight += new_likelihood - p.old_likelihood_logp
-                    p.old_likelihood_logp = new_likelihood
+                    tree_grew = particles[c].sample_tree_sequential(bart)
+                    # Update weights. Since the prior is used as the proposal,the weights
+                    # are updated additively as the ratio of the new and old log_likelihoods.
+                    # The ratio is 1 for the old particle and for those that did not grow,
+                    # so we only evaluate the likelihood of the particles that grew
+                    if tree_grew:
+                        self.update_weight(particles[c], c)
 
                 # Normalize weights
-                W, normalized_weights = self.normalize(particles)
+                W, normalized_weights = self.normalize()
 
                 # Resample all but first particle
                 re_n_w = normalized_weights[1:] / normalized_weights[1:].sum()
-                new_indices = np.random.choice(self.indices, size=len(self.indices), p=re_n_w)
-                particles[1:] = particles[new_indices]
+                # Positions are drawn from 0 and shifted to skip the first particle
+                new_indices = np.random.choice(self.len_indices, size=self.len_indices, p=re_n_w)
+                particles[1:] = self.resample_particles(particles, new_indices + 1)
+                self.old_likelihoods[1:] = self.old_likelihoods[new_indices + 1]
 
                 # Set the new weights
-                w_t = W - self.log_num_particles
-                for p in particles:
-                    p.log_weight = w_t
+                self.log_weights.fill(W - self.log_num_particles)
 
                 # Check if particles can keep growing, otherwise stop iterating
-                non_available_nodes_for_expansion = np.ones(self.num_particles - 1)
-                for c in range(1, self.num_particles):
-                    if len(particles[c].expansion_nodes) != 0:
-                        non_available_nodes_for_expansion[c - 1] = 0
-                if np.all(non_available_nodes_for_expansion):
+                if not any(p.expansion_nodes for p in particles[1:]):
                     break
 
             # Get the new tree and update
-            new_tree = np.random.choice(particles, p=normalized_weights)
+            new_tree = particles[np.random.choice(self.num_particles, p=normalized_weights)]
             self.old_trees_particles_list[tree.tree_id] = new_tree
             bart.trees[idx] = new_tree.tree
-            new_prediction = new_tree.tree.predict_output(num_observations)
-            bart.sum_trees_output = bart.Y - R_j + new_prediction
+            np.add(self.sum_trees_output_noi, new_tree.prediction, out=bart.sum_trees_output)
 
             if not self.tune:
                 self.iter += 1
@@ -175,11 +190,11 @@ class PGBART(ArrayStepShared):
             return Competence.IDEAL
         return Competence.INCOMPATIBLE
 
-    def normalize(self, particles):
+    def normalize(self):
         """
         Use logsumexp trick to get W and softmax to get normalized_weights
         """
-        log_w = np.array([p.log_weight for p in particles])
+        log_w = self.log_weights
         log_w_max = log_w.max()
         log_w_ = log_w - log_w_max
         w_ = np.exp(log_w_)
@@ -191,45 +206,75 @@ class PGBART(ArrayStepShared):
 
         return W, normalized_weights
 
+    def update_weight(self, particle, p_idx):
+        """
+        Update the weight of the particle at position p_idx given its current predicted output
+        """
+        new_likelihood = self.likelihood_logp(self.sum_trees_output_with(particle.prediction))
+        self.log_weights[p_idx] += new_likelihood - self.old_likelihoods[p_idx]
+        self.old_likelihoods[p_idx] = new_likelihood
+
+    def sum_trees_output_with(self, prediction):
+        """
+        Add the predicted output of a tree to the output of the other trees, reusing a buffer
+        """
+        return np.add(self.sum_trees_output_noi, prediction, out=self.output_buffer)
+
     def get_old_tree_particle(self, tree_id, t):
         old_tree_particle = self.old_trees_particles_list[tree_id]
         old_tree_particle.set_particle_to_step(t)
         return old_tree_particle
 
-    def init_particles(self, tree_id, R_j, num_observations):
+    def init_particles(self, tree_id, num_observations):
         """
         Initialize particles
         """
         # The first particle is from the tree we are trying to replace
         prev_tree = self.get_old_tree_particle(tree_id, 0)
-        likelihood = self.likelihood_logp(prev_tree.tree.predict_output(num_observations))
-        prev_tree.old_likelihood_logp = likelihood
-        prev_tree.log_weight = likelihood - self.log_num_particles
+        likelihood = self.likelihood_logp(self.sum_trees_output_with(prev_tree.prediction))
+        self.old_likelihoods[0] = likelihood
+        self.log_weights[0] = likelihood - self.log_num_particles
         particles = [prev_tree]
 
         # The rest of the particles are identically initialized
-        initial_value_leaf_nodes = R_j.mean()
+        # Mean of the residuals R_j = Y - sum_trees_output_noi
+        initial_value_leaf_nodes = self.bart.Y.mean() - self.sum_trees_output_noi.mean()
         initial_idx_data_points_leaf_nodes = np.arange(num_observations, dtype="int32")
         new_tree = Tree.init_tree(
             tree_id=tree_id,
             leaf_node_value=initial_value_leaf_nodes,
             idx_data_points=initial_idx_data_points_leaf_nodes,
         )
-        likelihood_logp = self.likelihood_logp(new_tree.predict_output(num_observations))
-        log_weight = likelihood_logp - self.log_num_particles
+        new_prediction = new_tree.predict_output(num_observations)
+        likelihood_logp = self.likelihood_logp(self.sum_trees_output_with(new_prediction))
+        self.old_likelihoods[1:] = likelihood_logp
+        self.log_weights[1:] = likelihood_logp - self.log_num_particles
         for i in range(1, self.num_particles):
-            particles.append(
-                ParticleTree(new_tree, self.bart.prior_prob_leaf_node, log_weight, likelihood_logp)
-            )
+            particles.append(ParticleTree(new_tree, self.bart.prior_prob_leaf_node, new_prediction))
 
-        return np.array(particles)
+        return particles
+
+    @staticmethod
+    def resample_particles(particles, new_indices):
+        """
+        Select the particles at new_indices, repeated particles share their tree until they grow
+        """
+        selected_indices = set()
+        new_particles = []
+        for p_idx in new_indices:
+            if p_idx in selected_indices:
+                new_particles.append(particles[p_idx].clone_shared())
+            else:
+                selected_indices.add(p_idx)
+                new_particles.append(particles[p_idx])
+        return new_particles
 
     def resample(self, particles, weights):
         """
         resample a set of particles given its weights
         """
-        particles = np.random.choice(particles, size=len(particles), p=weights)
-        return particles
+        new_indices = np.random.choice(len(particles), size=len(particles), p=weights)
+        return [particles[p_idx] for p_idx in new_indices]
 
 
 class ParticleTree:
@@ -237,35 +282,75 @@ class ParticleTree:
     Particle tree
     """
 
-    def __init__(self, tree, prior_prob_leaf_node, log_weight=0, likelihood=0):
-        self.tree = tree.copy()  # keeps the tree that we care at the moment
+    def __init__(self, tree, prior_prob_leaf_node, prediction):
+        # The tree and its predicted output can be shared with other particles,
+        # they are only copied the first time this particle grows its tree
+        self.tree = tree  # keeps the tree that we care at the moment
+        self.prediction = prediction  # predicted output of the tree at the moment
+        self._owned = False
         self.expansion_nodes = tree.idx_leaf_nodes.copy()  # This should be the array [0]
         self.tree_history = [self.tree]
         self.expansion_nodes_history = [self.expansion_nodes]
-        self.log_weight = 0
         self.prior_prob_leaf_node = prior_prob_leaf_node
-        self.old_likelihood_logp = likelihood
         self.used_variates = []
 
     def sample_tree_sequential(self, bart):
+        """
+        Try to grow the tree, return True if it grew
+        """
+        tree_grew = False
         if self.expansion_nodes:
             index_leaf_node = self.expansion_nodes.pop(0)
             # Probability that this node will remain a leaf node
             prob_leaf = self.prior_prob_leaf_node[self.tree[index_leaf_node].depth]
 
-            if prob_leaf < np.random.random():
-                grow_successful, index_selected_predictor = bart.grow_tree(
-                    self.tree, index_leaf_node
-                )
-                if grow_successful:
-                    # Add new leaf nodes indexes
-                    new_indexes = self.tree.idx_leaf_nodes[-2:]
-                    self.expansion_nodes.extend(new_indexes)
+            if prob_leaf < bart.uniform.random():
+                split = bart.draw_split_nodes(self.tree[index_leaf_node])
+                if split is not None:
+                    index_selected_predictor, new_split_node, *new_leaf_nodes = split
+                    # The tree is only copied when it is actually going to grow
+                    if not self._owned:
+                        self.own_tree()
+                    self.tree.grow_tree(index_leaf_node, new_split_node, *new_leaf_nodes)
+                    tree_grew = True
                     self.used_variates.append(index_selected_predictor)
+                    for new_leaf_node in new_leaf_nodes:
+                        # Add new leaf nodes indexes
+                        self.expansion_nodes.append(new_leaf_node.index)
+                        # Only the data points of the new leaf nodes change their predicted output
+                        self.prediction[new_leaf_node.idx_data_points] = new_leaf_node.value
 
             self.tree_history.append(self.tree)
             self.expansion_nodes_history.append(self.expansion_nodes)
 
+        return tree_grew
+
+    def own_tree(self):
+        """
+        Copy the shared tree and predicted output so this particle can modify them
+        """
+        self.tree = self.tree.copy()
+        self.prediction = self.prediction.copy()
+        # The history only holds references to the shared tree, point them to the copy
+        self.tree_history = [self.tree] * len(self.tree_history)
+        self._owned = True
+
+    def clone_shared(self):
+        """
+        Return a new particle that shares the tree and predicted output with this one
+        """
+        new_particle = copy(self)
+        new_particle.expansion_nodes = self.expansion_nodes.copy()
+        new_particle.tree_history = self.tree_history.copy()
+        new_particle.expansion_nodes_history = [new_particle.expansion_nodes] * len(
+            self.expansion_nodes_history
+        )
+        new_particle.used_variates = self.used_variates.copy()
+        # Neither particle can modify the tree in place anymore
+        self._owned = False
+        new_particle._owned = False
+        return new_particle
+
     def set_particle_to_step(self, t):
         if len(self.tree_history) <= t:
             self.tree = self.tree_history[-1]
@@ -288,6 +373,17 @@ def logp(point, out_vars, vars, shared):
         containing :class:`aesara.tensor.Tensor` for depended shared data
     """
     out_list, inarray0 = join_nonshared_inputs(point, out_vars, vars, shared)
-    f = aesara_function([inarray0], out_list[0])
-    f.trust_input = True
+    initial_array = np.concatenate([point[var.name].ravel() for var in vars]).astype(inarray0.dtype)
+    # The likelihood is evaluated for every particle at every stage, so we try to compile it
+    # with Numba. Numba compiles the function the first time it is called, so we call it here:
+    # any error (Numba not installed, an Op Numba can not type or lower) happens before sampling
+    # and makes us fall back to the default mode.
+    try:
+        f = aesara_function([inarray0], out_list[0], mode="NUMBA")
+        f.trust_input = True
+        f(initial_array)
+    except Exception as e:
+        _log.info(f"Could not compile the likelihood with Numba ({e!r}), using the default mode")
+        f = aesara_function([inarray0], out_list[0])
+        f.trust_input = True
     return f
@@ -0,0 +1,357 @@
+#   Copyright 2020 The PyMC Developers
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+
+from itertools import combinations
+from types import SimpleNamespace
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from scipy import stats
+
+import pymc3 as pm
+
+from pymc3.aesaraf import make_shared_replacements
+from pymc3.distributions.bart import (
+    BaseBART,
+    SampleSplittingVariable,
+    UniformSampler,
+    add_tree_output,
+    available_splitting_ranks,
+    compute_prior_probability,
+    fast_add_tree_output,
+    fast_residual_means,
+    fast_split_idx_data_points,
+    rank_predictors,
+    split_idx_data_points,
+)
+from pymc3.distributions.tree import LeafNode, SplitNode, Tree
+from pymc3.step_methods import pgbart
+from pymc3.step_methods.pgbart import PGBART, ParticleTree
+
+
+class BARTStub:
+    """Minimal replacement of BART with the methods used by ParticleTree"""
+
+    def __init__(self, X, Y):
+        self.X = X
+        self.Y = Y
+        self.uniform = UniformSampler()
+
+    def draw_split_nodes(self, current_node):
+        idx_data_points = current_node.idx_data_points
+        if idx_data_points.size < 2:
+            return None
+        idx_split_variable = np.random.randint(self.X.shape[1])
+        available_splitting_rules = np.unique(self.X[idx_data_points, idx_split_variable])[:-1]
+        if available_splitting_rules.size == 0:
+            return None
+        split_value = np.random.choice(available_splitting_rules)
+        left_idx_data_points, right_idx_data_points = split_idx_data_points(
+            self.X[:, idx_split_variable], idx_data_points, split_value
+        )
+        return (
+            idx_split_variable,
+            SplitNode(current_node.index, idx_split_variable, split_value),
+            LeafNode(
+                current_node.get_idx_left_child(),
+                self.Y[left_idx_data_points].mean(),
+                left_idx_data_points,
+            ),
+            LeafNode(
+                current_node.get_idx_right_child(),
+                self.Y[right_idx_data_points].mean(),
+                right_idx_data_points,
+            ),
+        )
+
+
+def init_particle_tree_stub(num_observations, num_variates=2):
+    X = np.random.normal(size=(num_observations, num_variates))
+    Y = np.random.normal(size=num_observations)
+    tree = Tree.init_tree(
+        tree_id=0,
+        leaf_node_value=Y.mean(),
+        idx_data_points=np.arange(num_observations, dtype="int32"),
+    )
+    return BARTStub(X, Y), tree, tree.predict_output(num_observations)
+
+
+def test_uniform_sampler_refill():
+    size = 10
+    np.random.seed(42)
+    expected = np.random.random(2 * size)
+
+    np.random.seed(42)
+    uniform = UniformSampler(size=size)
+    draws = [uniform.random() for _ in range(size)]
+    assert uniform.idx == size
+    # The next draw is taken from a new batch
+    draws.append(uniform.random())
+    assert uniform.idx == 1
+
+    draws = np.array(draws)
+    assert np.all((draws >= 0) & (draws < 1))
+    npt.assert_array_equal(draws, expected[: size + 1])
+
+
+def test_sample_splitting_variable_draws_valid_indexes():
+    # The normalized cumulative sum of this prior is 0.9999999999999999
+    split_prior = [1.0, 0.3]
+    uniform = UniformSampler(size=1)
+    ssv = SampleSplittingVariable(split_prior, len(split_prior), uniform)
+    assert ssv.cdf[-1] == 1.0
+    # The largest draw of the uniform sampler is the largest double below 1
+    uniform.cache = np.array([np.nextafter(1.0, 0.0)])
+    uniform.idx = 0
+    assert ssv.rvs() == len(split_prior) - 1
+
+
+@pytest.mark.parametrize("missing_data", [False, True])
+def test_split_idx_data_points(missing_data):
+    x_j = np.random.normal(size=50)
+    if missing_data:
+        x_j[::7] = np.nan
+    idx_data_points = np.arange(5, 45, dtype="int32")
+    split_value = np.nanmedian(x_j[idx_data_points])
+
+    left, right = split_idx_data_points(x_j, idx_data_points, split_value)
+    assert np.all(x_j[left] <= split_value)
+    assert not np.any(x_j[right] <= split_value)
+    npt.assert_array_equal(np.sort(np.concatenate([left, right])), idx_data_points)
+    if missing_data:
+        missing_idx = idx_data_points[np.isnan(x_j[idx_data_points])]
+        assert missing_idx.size > 0
+        assert np.all(np.isin(missing_idx, right))
+
+    pytest.importorskip("numba")
+    numba_left, numba_right = fast_split_idx_data_points()(x_j, idx_data_points, split_value)
+    npt.assert_array_equal(numba_left, left)
+    npt.assert_array_equal(numba_right, right)
+
+
+def test_fast_kernels_fall_back_to_numpy_without_numba(monkeypatch):
+    monkeypatch.setitem(sys.modules, "numba", None)
+    assert fast_split_idx_data_points() is split_idx_data_points
+    assert fast_add_tree_output() is add_tree_output
+
+
+def test_resampled_particles_share_trees_until_they_grow():
+    np.random.seed(42)
+    num_observations = 50
+    num_particles = 6
+    bart, tree, prediction = init_particle_tree_stub(num_observations)
+    prior_prob_leaf_node = compute_prior_probability(0.95)
+    particles = [ParticleTree(tree, prior_prob_leaf_node, prediction) for _ in range(num_particles)]
+
+    for _ in range(10):
+        for p in particles:
+            p.sample_tree_sequential(bart)
+        for p in particles:
+            npt.assert_array_equal(p.prediction, p.tree.predict_output(num_observations))
+
+        new_indices = np.random.randint(num_particles, size=num_particles)
+        particles = PGBART.resample_particles(particles, new_indices)
+        for p, q in combinations(particles, 2):
+            assert p is not q
+            if p.tree is q.tree:
+                assert p.prediction is q.prediction
+                assert not p._owned and not q._owned
+
+    # The tree shared by the initial particles is never modified
+    assert tree.num_nodes == 1
+    npt.assert_array_equal(prediction, bart.Y.mean())
+
+
+def test_growing_a_clone_does_not_modify_its_sibling():
+    np.random.seed(42)
+    num_observations = 50
+    bart, tree, prediction = init_particle_tree_stub(num_observations)
+    particle = ParticleTree(tree, compute_prior_probability(0.95), prediction)
+    # The root node is always grown
+    assert particle.sample_tree_sequential(bart)
+
+    clone = particle.clone_shared()
+    assert clone.tree is particle.tree
+    nodes = list(particle.tree.tree_structure)
+    particle_prediction = particle.prediction.copy()
+    expansion_nodes = particle.expansion_nodes.copy()
+
+    assert any(clone.sample_tree_sequential(bart) for _ in range(len(expansion_nodes)))
+    assert clone.tree is not particle.tree
+    assert list(particle.tree.tree_structure) == nodes
+    assert particle.expansion_nodes == expansion_nodes
+    npt.assert_array_equal(particle.prediction, particle_prediction)
+    npt.assert_array_equal(clone.prediction, clone.tree.predict_output(num_observations))
+
+
+def test_failed_grow_does_not_copy_the_tree():
+    bart, _, _ = init_particle_tree_stub(10)
+    # A node with a single data point can not be split
+    tree = Tree.init_tree(tree_id=0, leaf_node_value=0.0, idx_data_points=np.array([0], "int32"))
+    prediction = tree.predict_output(10)
+    particle = ParticleTree(tree, compute_prior_probability(0.95), prediction)
+
+    assert not particle.sample_tree_sequential(bart)
+    assert particle.tree is tree
+    assert particle.prediction is prediction
+    assert not particle._owned
+
+
+@pytest.mark.parametrize("missing_data", [False, True])
+@pytest.mark.parametrize("num_data_points", [5, 60], ids=["sorted_ranks", "marked_ranks"])
+def test_available_splitting_ranks(missing_data, num_data_points):
+    np.random.seed(42)
+    num_observations = 100
+    # Few distinct values so the nodes have repeated values
+    X = np.random.randint(0, 20, size=(num_observations, 2)).astype(float)
+    if missing_data:
+        X[::3, 1] = np.nan
+    nan_mask = np.isnan(X)
+    X_unique, X_rank = rank_predictors(X)
+    idx_data_points = np.random.choice(num_observations, num_data_points, replace=False)
+
+    for j in range(X.shape[1]):
+        ranks = available_splitting_ranks(
+            idx_data_points,
+            X_rank[:, j],
+            X_unique[j].size,
+            nan_mask[:, j] if missing_data else None,
+        )
+        x_j = X[idx_data_points, j]
+        expected = np.unique(x_j[~np.isnan(x_j)])[:-1]
+        npt.assert_array_equal(X_unique[j][ranks], expected)
+
+
+class TestLogp:
+    def compile_logp(self):
+        with pm.Model() as model:
+            pm.Normal("x", 0, 1, size=3)
+        point = model.initial_point
+        vars = model.value_vars
+        shared = make_shared_replacements(point, vars, model)
+        return pgbart.logp(point, [model.logpt], vars, shared)
+
+    def test_logp(self):
+        f = self.compile_logp()
+        x = np.array([0.5, -1.0, 2.0])
+        npt.assert_allclose(f(x), stats.norm.logpdf(x).sum())
+
+    def test_logp_numba_failure_falls_back_to_default_mode(self, monkeypatch):
+        aesara_function = pgbart.aesara_function
+        modes = []
+
+        def numba_fails_on_first_call(inputs, outputs, mode=None):
+            modes.append(mode)
+            if mode == "NUMBA":
+                # Numba only types and lowers the function when it is first called
+                def f(*args):
+                    raise RuntimeError("Numba can not type this function")
+
+                return f
+            return aesara_function(inputs, outputs)
+
+        monkeypatch.setattr(pgbart, "aesara_function", numba_fails_on_first_call)
+        f = self.compile_logp()
+        assert modes == ["NUMBA", None]
+        x = np.array([0.5, -1.0, 2.0])
+        npt.assert_allclose(f(x), stats.norm.logpdf(x).sum())
+
+
+def grow_chain(tree, X, Y, depth, index_leaf_node=0):
+    """Grow a tree that always splits the right child on its smallest value"""
+    for _ in range(depth):
+        current_node = tree[index_leaf_node]
+        split_value = X[current_node.idx_data_points, 0].min()
+        left_idx_data_points, right_idx_data_points = split_idx_data_points(
+            X[:, 0], current_node.idx_data_points, split_value
+        )
+        tree.grow_tree(
+            index_leaf_node,
+            SplitNode(index_leaf_node, 0, split_value),
+            LeafNode(
+                current_node.get_idx_left_child(),
+                Y[left_idx_data_points].mean(),
+                left_idx_data_points,
+            ),
+            LeafNode(
+                current_node.get_idx_right_child(),
+                Y[right_idx_data_points].mean(),
+                right_idx_data_points,
+            ),
+        )
+        index_leaf_node = current_node.get_idx_right_child()
+    return index_leaf_node
+
+
+def test_add_tree_output():
+    np.random.seed(42)
+    num_observations = 40
+    bart, tree, _ = init_particle_tree_stub(num_observations)
+    for _ in range(15):
+        index_leaf_node = np.random.choice(tree.idx_leaf_nodes)
+        split = bart.draw_split_nodes(tree[index_leaf_node])
+        if split is not None:
+            tree.grow_tree(index_leaf_node, *split[1:])
+
+    _, chain_tree, _ = init_particle_tree_stub(num_observations)
+    # The deepest leaf nodes of this tree have indexes larger than 2 ** 30
+    index_leaf_node = grow_chain(chain_tree, bart.X, bart.Y, depth=30)
+
+    X_new = np.concatenate([bart.X, np.random.normal(size=(20, bart.X.shape[1]))])
+    # Missing values go to the right child
+    X_new[::9, 0] = np.nan
+    X_new[::11, 1] = np.nan
+    fast_add_tree_output_ = fast_add_tree_output()
+    for tree_ in (tree, chain_tree):
+        layout = tree_.to_array_layout()
+        assert all(array.size == tree_.num_nodes for array in layout)
+        expected = [tree_.predict_out_of_sample(x) for x in X_new]
+
+        output = np.zeros(X_new.shape[0])
+        add_tree_output(X_new, *layout, output)
+        npt.assert_array_equal(output, expected)
+
+        output = np.ones(X_new.shape[0])
+        fast_add_tree_output_(X_new, *layout, output)
+        npt.assert_array_equal(output, np.add(1, expected))
+
+    # The arrays are computed again after the tree grows
+    num_nodes = chain_tree.num_nodes
+    grow_chain(chain_tree, bart.X, bart.Y, depth=1, index_leaf_node=index_leaf_node)
+    assert chain_tree.to_array_layout()[0].size == num_nodes + 2
+
+
+def test_leaf_values_are_residual_means_without_the_replaced_tree():
+    np.random.seed(42)
+    num_observations = 30
+    stub, tree, _ = init_particle_tree_stub(num_observations)
+    old_tree_prediction = np.random.normal(size=num_observations)
+    sum_trees_output_noi = np.random.normal(size=num_observations)
+    bart = SimpleNamespace(
+        Y=stub.Y,
+        sum_trees_output=sum_trees_output_noi + old_tree_prediction,
+        sum_trees_output_noi=sum_trees_output_noi,
+        residual_means=fast_residual_means(),
+    )
+    left, right = split_idx_data_points(stub.X[:, 0], tree[0].idx_data_points, 0.0)
+
+    residuals = stub.Y - sum_trees_output_noi
+    npt.assert_allclose(
+        BaseBART.draw_leaf_values(bart, left, right),
+        (residuals[left].mean(), residuals[right].mean()),
+    )